@@ -10,6 +10,7 @@ import sqlite3
 import datetime
 import os
 import warnings
+import xml.etree.ElementTree as ET
 
 import numpy as np
 import pandas as pd
@@ -19,6 +20,7 @@ import matplotlib.dates as mdates
 from pathlib import Path
 from os import listdir
 from os.path import isfile, join
+from multiprocessing import Pool
 
 with warnings.catch_warnings():
     warnings.filterwarnings("ignore", category=FutureWarning)
@@ -32,6 +34,14 @@ NOW = datetime.datetime.now()
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
+EARTH_RADIUS_MI = 3958.8
+MOVING_SPEED = 0.5 / 1609.344  # mi/s (~1.1 mph), slower counts as stopped
+TRACK_EXTENSIONS = ('.gpx', '.tcx')
+MAD_SCALE = 1.4826  # MAD -> std for normally distributed data
+HAMPEL_MIN_SIGMA = 0.01  # fraction of the window median, keeps flat stretches from flagging scale jitter
+HAMPEL_CHUNK = 2 ** 20  # window values held in memory at once
+CLEAN_SAMPLE = 10  # flagged records shown by 'clean'
+
 # =============================================================================
 # Utility Functions
 # =============================================================================
@@ -88,6 +98,175 @@ def sec_to_str(sec):
 
     return str(hours) + ":" + str(minutes) + ":" + str(seconds)
 
+def has_table(c, table):
+    '''
+    Checks to see if a table exists in a user database
+    '''
+
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    return c.fetchone() is not None
+
+def has_column(c, table, column):
+    '''
+    Checks to see if a table in a user database has a column
+    '''
+
+    return column in [row[1] for row in c.execute("PRAGMA table_info(" + table + ")")]
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''
+    Great-circle distance (mi) between coordinates, works element-wise on arrays
+    '''
+
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_MI * np.arcsin(np.sqrt(a))
+
+def parse_track(path):
+    '''
+    Streams track points out of a GPX/TCX file into lat, lon and time arrays
+    '''
+
+    lats = []
+    lons = []
+    times = []
+    lat = lon = time = None
+    parents = []
+
+    # Finished elements are detached from their parent so the xml tree never holds more than one point
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]  # strip xml namespace
+
+        if event == 'start':
+            if tag in ('trkpt', 'Trackpoint'):
+                lat = lon = time = None
+            parents.append(elem)
+            continue
+
+        parents.pop()
+
+        if tag in ('time', 'Time'):
+            time = elem.text
+        elif tag in ('LatitudeDegrees', 'LongitudeDegrees'):
+            if not elem.text:
+                raise ValueError("Empty " + tag + " in " + str(path))
+            if tag == 'LatitudeDegrees':
+                lat = float(elem.text)
+            else:
+                lon = float(elem.text)
+        elif tag in ('trkpt', 'Trackpoint'):
+            if tag == 'trkpt':
+                if elem.get('lat') is None or elem.get('lon') is None:
+                    raise ValueError("Track point missing lat/lon in " + str(path))
+                lat = float(elem.get('lat'))
+                lon = float(elem.get('lon'))
+            if lat is not None and lon is not None and time is not None:
+                lats.append(lat)
+                lons.append(lon)
+                times.append(time)
+
+        if parents:
+            parents[-1].remove(elem)
+
+    return np.array(lats), np.array(lons), pd.to_datetime(times, utc=True, format='ISO8601')
+
+def summarize_track(path):
+    '''
+    Summarizes a GPX/TCX file into (date, distance, moving time, splits)
+
+    Splits are (mile, distance, time) tuples, the last one being the partial mile
+    '''
+
+    lats, lons, times = parse_track(path)
+
+    if len(lats) < 2:
+        raise ValueError("Need at least 2 timed track points in " + str(path))
+
+    dist = haversine(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    dt = np.diff(times.values).astype('timedelta64[ms]').astype(float) / 1000
+
+    # Only count time spent above walking pace
+    moving = (dt > 0) & (dist >= MOVING_SPEED * dt)
+    moving_dt = np.where(moving, dt, 0)
+
+    cum_dist = np.concatenate(([0], np.cumsum(dist)))
+    cum_time = np.concatenate(([0], np.cumsum(moving_dt)))
+    distance = cum_dist[-1]
+    moving_time = cum_time[-1]
+
+    if distance == 0:
+        raise ValueError("Track has no movement in " + str(path))
+
+    # Moving time at each mile mark, then per-mile differences
+    marks = np.arange(1, int(distance) + 1)
+    mark_times = np.concatenate(([0], np.interp(marks, cum_dist, cum_time), [moving_time]))
+    mark_dists = np.concatenate(([0], marks, [distance]))
+    split_dists = np.diff(mark_dists)
+    split_times = np.diff(mark_times)
+
+    splits = [(i + 1, float(d), float(t)) for i, (d, t) in enumerate(zip(split_dists, split_times)) if d > 0]
+
+    date = times[0].to_pydatetime().astimezone().strftime("%Y-%m-%d")
+
+    return date, float(distance), float(moving_time), splits
+
+def hampel(weights, window=15, n_sigmas=3):
+    '''
+    Flags outliers with a centered rolling median/MAD (Hampel) filter
+
+    Points near either end are judged against the first/last full window
+    rather than a shrunk centered one. Sigma never drops below
+    HAMPEL_MIN_SIGMA of the window median, whatever the weight unit.
+    '''
+
+    weights = np.asarray(weights, dtype=float)
+    if len(weights) == 0:
+        return np.zeros(0, dtype=bool)
+    window = min(window, len(weights))
+
+    # Median and MAD of every full window, a chunk of windows at a time so
+    # memory doesn't grow with rows * window
+    median = np.empty(len(weights) - window + 1)
+    mad = np.empty_like(median)
+    step = max(1, HAMPEL_CHUNK // window)
+    for i in range(0, len(median), step):
+        windows = np.lib.stride_tricks.sliding_window_view(weights[i:i + step + window - 1], window)
+        median[i:i + step] = np.median(windows, axis=1)
+        mad[i:i + step] = np.median(np.abs(windows - median[i:i + step, None]), axis=1)
+
+    # Window each point is judged against, clamped to the series ends
+    start = np.clip(np.arange(len(weights)) - window // 2, 0, len(median) - 1)
+    sigma = np.maximum(MAD_SCALE * mad[start], HAMPEL_MIN_SIGMA * np.abs(median[start]))
+
+    return np.abs(weights - median[start]) > n_sigmas * sigma
+
+def has_outlier_flags(c):
+    '''
+    Checks to see if the records table has the outlier column from 'clean'
+    '''
+
+    return has_column(c, 'records', 'outlier')
+
+def outlier_clause(c, clean):
+    '''
+    SQL condition for record queries, drops records flagged by 'clean' if asked to
+    '''
+
+    if clean and has_outlier_flags(c):
+        return "outlier = 0"
+    return "1 = 1"
+
+def _summarize_file(path):
+    '''
+    Pool worker for summarize_track, returns (path, summary, error)
+    '''
+
+    try:
+        return path, summarize_track(path), None
+    except (ET.ParseError, ValueError, OSError) as e:
+        return path, None, str(e)
+
 # Init App Entry
 @click.group(context_settings=CONTEXT_SETTINGS)
 @click.version_option(version='0.8.0')
@@ -135,9 +314,11 @@ def add(user, date, weight):
 
     if date_exists is not None:  # SQL UPDATE
         c.execute("UPDATE records SET weight=" + str(weight) + " WHERE date = '" + str(date) + "'")
+        if has_outlier_flags(c):  # new weight hasn't been checked yet
+            c.execute("UPDATE records SET outlier=0 WHERE date=?", date_sql)
         click.echo("[" + click.style('Updated', fg='green', bold=True) + "] - user: " + str(user) + ", date: " + str(date) + ", weight: " + str(weight))
     else: # SQL ADD
-        c.execute("INSERT INTO records VALUES ('" + str(date) + "', "+ str(weight) + ")")
+        c.execute("INSERT INTO records (date, weight) VALUES ('" + str(date) + "', "+ str(weight) + ")")
         click.echo("[" + click.style('Added', fg='green', bold=True) + "] - user: " + str(user) + ", date: " + str(date) + ", weight: " + str(weight))
 
     conn.commit()
@@ -228,6 +409,10 @@ def addrun(user, date, distance, time):
         c.execute("INSERT INTO runs VALUES ('" + str(date) + "', "+ str(distance) + ", "+ str(time) + ")")
         click.echo("[" + click.style('Added', fg='green', bold=True) + "] - user: " + str(user) + ", date: " + str(date) + ", distance: " + str(distance) + ", time: " + sec_to_str(time))
 
+    # Any imported splits no longer match this run
+    if has_table(c, 'splits'):
+        c.execute("DELETE FROM splits WHERE date=?", date_sql)
+
     conn.commit()
     conn.close()
 
@@ -260,6 +445,11 @@ def deleterun(user, date):
     date_exists = c.fetchone()
     if date_exists is not None:
         c.execute("DELETE FROM runs WHERE date = '" + str(date) + "'")
+
+        # Databases created before importrun may not have splits
+        if has_table(c, 'splits'):
+            c.execute("DELETE FROM splits WHERE date=?", date_sql)
+
         click.echo("[" + click.style('DELETED', fg='green', bold=True) + "] - user: " + str(user) + ", date: " + str(date))
     else:
         click.echo("[" + click.style('ERROR', fg='red', bold=True) + "] - Run with that date does not exist")
@@ -267,6 +457,87 @@ def deleterun(user, date):
     conn.commit()
     conn.close()
 
+@bodylogger.command()
+@click.argument('user')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('-s', '--splits',
+              is_flag=True,
+              help="Also store per-mile splits, numbered per run")
+@click.option('-j', '--jobs',
+              type=int,
+              default=os.cpu_count(),
+              help="Worker processes used when importing a directory (Default: CPU count)")
+def importrun(user, path, splits, jobs):
+    """
+    Imports runs from a GPX/TCX file or directory
+
+    A run on a date that already has one is added to that date's total.
+    """
+
+    # Check for user
+    if not is_user(user):
+        click.echo("[" + click.style('ERROR', fg='red', bold=True) + "] - User " + str(user) + " not found. Please see 'listusers' for a user list, or 'createuser' to create one.")
+        return 1
+
+    if os.path.isdir(path):
+        files = sorted([join(path, f) for f in listdir(path) if isfile(join(path, f)) and f.lower().endswith(TRACK_EXTENSIONS)])
+    else:
+        files = [path]
+
+    if not files:
+        click.echo("[" + click.style('ERROR', fg='red', bold=True) + "] - No GPX/TCX files found in " + str(path))
+        return 1
+
+    # Parse files in parallel, sqlite writes stay in this process
+    if len(files) > 1 and jobs > 1:
+        with Pool(min(jobs, len(files))) as pool:
+            results = pool.map(_summarize_file, files)
+    else:
+        results = [_summarize_file(f) for f in files]
+
+    conn = sqlite3.connect(_ROOT + '/users/' + str(user) + '.db')
+    c = conn.cursor()
+
+    if splits:
+        c.execute("CREATE TABLE IF NOT EXISTS splits (date text, run integer, mile integer, distance float, time float)")
+        if not has_column(c, 'splits', 'run'):  # splits from before runs were numbered
+            c.execute("ALTER TABLE splits ADD COLUMN run integer DEFAULT 1")
+
+    for f, summary, error in results:
+        if error is not None:
+            click.echo("[" + click.style('ERROR', fg='red', bold=True) + "] - Could not import " + str(f) + ": " + error)
+            continue
+
+        date, distance, time, run_splits = summary
+        distance = round(distance, 2)
+        time = round(time)
+
+        # Check for date in db
+        date_sql = (date,)
+        c.execute("SELECT distance, time FROM runs WHERE date=?", date_sql)
+        existing = c.fetchone()
+
+        if existing is not None:  # SQL UPDATE, same-day runs add up
+            total_distance = round(existing[0] + distance, 2)
+            total_time = existing[1] + time
+            c.execute("UPDATE runs SET distance=?, time=? WHERE date=?", (total_distance, total_time, date))
+            click.echo("[" + click.style('Updated', fg='green', bold=True) + "] - user: " + str(user) + ", date: " + str(date) + ", distance: " + str(distance) + ", time: " + sec_to_str(time) + " (day total: " + str(total_distance) + ", " + sec_to_str(total_time) + ")")
+        else: # SQL ADD
+            c.execute("INSERT INTO runs VALUES (?, ?, ?)", (date, distance, time))
+            click.echo("[" + click.style('Added', fg='green', bold=True) + "] - user: " + str(user) + ", date: " + str(date) + ", distance: " + str(distance) + ", time: " + sec_to_str(time))
+
+        if splits:
+            # Each run keeps its own mile numbers
+            c.execute("SELECT COALESCE(MAX(run), 0) + 1 FROM splits WHERE date=?", date_sql)
+            run = c.fetchone()[0]
+            c.executemany("INSERT INTO splits (date, run, mile, distance, time) VALUES (?, ?, ?, ?, ?)",
+                          [(date, run, mile, round(d, 2), round(t)) for mile, d, t in run_splits])
+            for mile, d, t in run_splits:
+                click.echo("    run " + str(run) + ", mile " + str(mile) + ": " + str(round(d, 2)) + ", " + sec_to_str(t))
+
+    conn.commit()
+    conn.close()
+
 # list
 @bodylogger.command()
 @click.argument('user')
@@ -291,7 +562,7 @@ def list(user, n):
     # Weight
     click.echo("[" + click.style("DISPLAYING LAST " + str(n) + " RECORDS", fg='green') + "]")
     records = []
-    for row in c.execute('SELECT * FROM records ORDER BY date DESC LIMIT ?', n_wrap):
+    for row in c.execute('SELECT date, weight FROM records ORDER BY date DESC LIMIT ?', n_wrap):
         records.append(row)
 
     if not records:  # is_empty check
@@ -319,7 +590,10 @@ def list(user, n):
 
 @bodylogger.command()
 @click.argument('user')
-def stats(user):
+@click.option('-c', '--clean',
+              is_flag=True,
+              help="Exclude records flagged by 'clean'")
+def stats(user, clean):
     """
     Gives user stats and predictions
     """
@@ -334,9 +608,13 @@ def stats(user):
 
     click.echo("[" + click.style("BODY STATISTICS FOR USER - " + str(user), fg='green') + "]")
 
+    if clean and not has_outlier_flags(c):
+        click.echo("[" + click.style('NOTICE', fg='yellow', bold=True) + "] - No outlier flags found, showing all records. See 'clean' to flag them.")
+    outlier_sql = outlier_clause(c, clean)
+
     # Current Weight and Total Weight lost
     records = []
-    for row in c.execute('SELECT * FROM records ORDER BY date'):
+    for row in c.execute('SELECT date, weight FROM records WHERE ' + outlier_sql + ' ORDER BY date'):
         records.append(row)
 
     if len(records) != 0:
@@ -357,7 +635,7 @@ def stats(user):
 
         # Weight Lost in Past 90 Days
         records = []
-        for row in c.execute("SELECT * FROM records WHERE date BETWEEN datetime('now', '-90 days') AND datetime('now', 'localtime') ORDER BY date;"):
+        for row in c.execute("SELECT date, weight FROM records WHERE date BETWEEN datetime('now', '-90 days') AND datetime('now', 'localtime') AND " + outlier_sql + " ORDER BY date;"):
             records.append(row)
 
         if len(records) == 1:
@@ -373,7 +651,7 @@ def stats(user):
 
         # Weight Lost in Past 30 Days
         records = []
-        for row in c.execute("SELECT * FROM records WHERE date BETWEEN datetime('now', '-30 days') AND datetime('now', 'localtime') ORDER BY date;"):
+        for row in c.execute("SELECT date, weight FROM records WHERE date BETWEEN datetime('now', '-30 days') AND datetime('now', 'localtime') AND " + outlier_sql + " ORDER BY date;"):
             records.append(row)
 
         if len(records) == 1:
@@ -390,7 +668,7 @@ def stats(user):
 
         # Weight Lost in Past 7 Days
         records = []
-        for row in c.execute("SELECT * FROM records WHERE date BETWEEN datetime('now', '-7 days') AND datetime('now', 'localtime') ORDER BY date;"):
+        for row in c.execute("SELECT date, weight FROM records WHERE date BETWEEN datetime('now', '-7 days') AND datetime('now', 'localtime') AND " + outlier_sql + " ORDER BY date;"):
             records.append(row)
 
         if len(records) == 1:
@@ -463,12 +741,66 @@ def stats(user):
     conn.close()
 
 
+@bodylogger.command()
+@click.argument('user')
+@click.option('-w', '--window',
+              type=click.IntRange(min=3, max=91),
+              default=15,
+              help="Number of records in the rolling window, 3-91 (Default: 15)")
+@click.option('-s', '--sigmas',
+              type=click.FloatRange(min=0, min_open=True),
+              default=3.0,
+              help="Deviations from the rolling median to flag (Default: 3)")
+def clean(user, window, sigmas):
+    """
+    Flags outlier records
+    """
+
+    # Check for user
+    if not is_user(user):
+        click.echo("[" + click.style('ERROR', fg='red', bold=True) + "] - User " + str(user) + " not found. Please see 'listusers' for a user list, or 'createuser' to create one.")
+        return 1
+
+    conn = sqlite3.connect(_ROOT + '/users/' + str(user) + '.db')
+    c = conn.cursor()
+
+    if not has_outlier_flags(c):
+        c.execute("ALTER TABLE records ADD COLUMN outlier integer DEFAULT 0")
+
+    records_df = pd.read_sql_query('SELECT rowid, date, weight, outlier FROM records ORDER BY date', conn)
+
+    if len(records_df) == 0:
+        click.echo("[" + click.style('NOTICE', fg='yellow', bold=True) + "] - No weights recorded.")
+        conn.close()
+        return 1
+
+    flags = hampel(records_df['weight'], window, sigmas).astype(int)
+
+    # Only write rows whose flag changed
+    changed = records_df[records_df['outlier'].values != flags]
+    c.executemany("UPDATE records SET outlier=? WHERE rowid=?",
+                  zip(flags[changed.index].tolist(), changed['rowid'].tolist()))
+
+    flagged = records_df[flags == 1]
+    click.echo("[" + click.style("FLAGGED " + str(len(flagged)) + " OF " + str(len(records_df)) + " RECORDS", fg='green') + "]")
+    for r in flagged.head(CLEAN_SAMPLE).itertuples():
+        click.echo(str(r.date) + ": " + str(r.weight))
+    if len(flagged) > CLEAN_SAMPLE:
+        click.echo("... and " + str(len(flagged) - CLEAN_SAMPLE) + " more")
+
+    conn.commit()
+    conn.close()
+
+
 @bodylogger.command()
 @click.argument('user')
 @click.option('-o', '--output',
               default=False,
               help="Specify output filename")
-def plot(user, output):
+@click.option('-c', '--clean',
+              is_flag=True,
+              help="Exclude records flagged by 'clean'")
+def plot(user, output, clean):
     """
     Plots records
     """
@@ -481,9 +813,13 @@ def plot(user, output):
     conn = sqlite3.connect(_ROOT + '/users/' + str(user) + '.db')
     c = conn.cursor()
 
+    if clean and not has_outlier_flags(c):
+        click.echo("[" + click.style('NOTICE', fg='yellow', bold=True) + "] - No outlier flags found, plotting all records. See 'clean' to flag them.")
+    outlier_sql = outlier_clause(c, clean)
+
     # Current Weight and Total Weight lost
     records = []
-    for row in c.execute('SELECT * FROM records ORDER BY date'):
+    for row in c.execute('SELECT date, weight FROM records WHERE ' + outlier_sql + ' ORDER BY date'):
         records.append(row)
 
     # Check for weights for plot
@@ -560,8 +896,9 @@ def createuser(user):
     c = conn.cursor()
 
     # Create table if doesn't exist
-    c.execute("CREATE TABLE IF NOT EXISTS records (date text, weight float)")
+    c.execute("CREATE TABLE IF NOT EXISTS records (date text, weight float, outlier integer DEFAULT 0)")
     c.execute("CREATE TABLE IF NOT EXISTS runs (date text, distance float, time float)")
+    c.execute("CREATE TABLE IF NOT EXISTS splits (date text, run integer, mile integer, distance float, time float)")
 
     conn.commit()
     click.echo("[" + click.style('CREATED USER', fg='green', bold=True) + "] - user: " + str(user))
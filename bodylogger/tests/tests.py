@@ -1,5 +1,5 @@
 # Add parent dir to path
-import os,sys,inspect
+import os,sys,inspect,tempfile
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir) 
@@ -7,6 +7,51 @@ sys.path.insert(0,parentdir)
 from bodylogger import check_date
 from bodylogger import str_to_sec
 from bodylogger import sec_to_str
+from bodylogger import haversine
+from bodylogger import summarize_track
+from bodylogger import hampel
+
+GPX = '''<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">
+  <metadata><time>2017-11-12T00:00:00Z</time></metadata>
+  <trk><trkseg>
+    <trkpt lat="40.0000" lon="-75.0"><time>2017-11-12T12:00:00Z</time></trkpt>
+    <trkpt lat="40.0145" lon="-75.0"><time>2017-11-12T12:10:00Z</time></trkpt>
+    <trkpt lat="40.0145" lon="-75.0"><time>2017-11-12T12:15:00Z</time></trkpt>
+    <trkpt lat="40.0217" lon="-75.0"><time>2017-11-12T12:20:00Z</time></trkpt>
+  </trkseg></trk>
+</gpx>
+'''
+
+TCX = '''<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">
+  <Activities><Activity Sport="Running">
+    <Id>2017-11-12T12:00:00Z</Id>
+    <Lap StartTime="2017-11-12T12:00:00Z"><TotalTimeSeconds>1200</TotalTimeSeconds><Track>
+      <Trackpoint><Time>2017-11-12T12:00:00Z</Time><Position><LatitudeDegrees>40.0000</LatitudeDegrees><LongitudeDegrees>-75.0</LongitudeDegrees></Position></Trackpoint>
+      <Trackpoint><Time>2017-11-12T12:05:00Z</Time><HeartRateBpm><Value>150</Value></HeartRateBpm></Trackpoint>
+      <Trackpoint><Time>2017-11-12T12:10:00Z</Time><Position><LatitudeDegrees>40.0145</LatitudeDegrees><LongitudeDegrees>-75.0</LongitudeDegrees></Position></Trackpoint>
+      <Trackpoint><Time>2017-11-12T12:15:00Z</Time><Position><LatitudeDegrees>40.0145</LatitudeDegrees><LongitudeDegrees>-75.0</LongitudeDegrees></Position></Trackpoint>
+      <Trackpoint><Time>2017-11-12T12:20:00Z</Time><Position><LatitudeDegrees>40.0217</LatitudeDegrees><LongitudeDegrees>-75.0</LongitudeDegrees></Position></Trackpoint>
+    </Track></Lap>
+  </Activity></Activities>
+</TrainingCenterDatabase>
+'''
+
+def summarize_text(text, suffix):
+    with tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False) as f:
+        f.write(text)
+    try:
+        return summarize_track(f.name)
+    finally:
+        os.remove(f.name)
+
+def assert_bad_track(text, suffix):
+    try:
+        summarize_text(text, suffix)
+        assert False
+    except ValueError as e:
+        assert suffix in str(e)  # error names the file
 
 def test_check_date():
     assert check_date('11/11/2017') == False
@@ -34,7 +79,76 @@ def test_sec_to_str():
     assert sec_to_str(5656) == '01:34:16'
     assert sec_to_str(38056) == '10:34:16'  
 
+def test_haversine():
+    assert haversine(40.0, -75.0, 40.0, -75.0) == 0
+    assert round(haversine(0.0, 0.0, 1.0, 0.0), 1) == 69.1
+    assert [round(d, 1) for d in haversine([0.0, 0.0], [0.0, 0.0], [1.0, 0.0], [0.0, 1.0])] == [69.1, 69.1]
+
+def test_summarize_track():
+    date, distance, time, splits = summarize_text(GPX, '.gpx')
+
+    assert round(distance, 1) == 1.5
+    assert time == 900  # 5 minute stop is not moving time
+    assert len(splits) == 2
+    assert splits[0][0] == 1 and splits[0][1] == 1
+    assert round(splits[0][2], -1) == 600
+    assert round(splits[1][1], 1) == 0.5
+
+def test_summarize_track_mixed_time_formats():
+    gpx = GPX.replace('12:10:00Z', '12:10:00.500Z').replace('12:20:00Z', '12:20:00+00:00')
+    date, distance, time, splits = summarize_text(gpx, '.gpx')
+    assert round(distance, 1) == 1.5
+    assert time == 900.5  # fractional seconds are kept
+
+def test_summarize_track_tcx():
+    date, distance, time, splits = summarize_text(TCX, '.tcx')
+    assert date == summarize_text(GPX, '.gpx')[0]
+    assert round(distance, 1) == 1.5
+    assert time == 900  # Position-less Trackpoint is skipped
+    assert [s[0] for s in splits] == [1, 2]
+
+def test_summarize_track_bad_input():
+    assert_bad_track(GPX.replace(' lon="-75.0"><time>2017-11-12T12:20:00Z', '><time>2017-11-12T12:20:00Z'), '.gpx')
+    assert_bad_track(TCX.replace('<LatitudeDegrees>40.0217</LatitudeDegrees>', '<LatitudeDegrees></LatitudeDegrees>'), '.tcx')
+    assert_bad_track(GPX.replace('lat="40.0145"', 'lat="40.0000"').replace('lat="40.0217"', 'lat="40.0000"'), '.gpx')  # no movement
+
+def test_hampel():
+    weights = [180.2, 180.0, 179.8, 179.6, 200.4, 179.4, 179.2, 179.0, 81.3, 178.8]
+    assert list(hampel(weights)) == [False] * 4 + [True] + [False] * 3 + [True, False]
+    assert not hampel([180.0] * 10 + [180.2]).any()  # scale jitter on a flat stretch
+
+def test_hampel_ends():
+    # Consecutive bad readings at either end can't pull a shrunk window toward them
+    assert list(hampel([180.0] * 10 + [81.6, 81.6])) == [False] * 10 + [True, True]
+    assert list(hampel([180.0] * 10 + [200.4, 200.4])) == [False] * 10 + [True, True]
+    assert list(hampel([81.6, 81.6] + [180.0] * 10)) == [True, True] + [False] * 10
+    assert list(hampel([180.0, 81.6, 180.0])) == [False, True, False]  # shorter than the window
+
+def test_hampel_large_window():
+    import bodylogger
+
+    weights = [180.0 + (i % 7) * 0.3 for i in range(2000)]
+    weights[0] = weights[1000] = weights[1999] = 81.6
+    flags = hampel(weights, window=91)
+    assert list(flags.nonzero()[0]) == [0, 1000, 1999]
+
+    # Same result when the windows are split over many chunks
+    chunk = bodylogger.HAMPEL_CHUNK
+    bodylogger.HAMPEL_CHUNK = 200
+    try:
+        assert (hampel(weights, window=91) == flags).all()
+    finally:
+        bodylogger.HAMPEL_CHUNK = chunk
+
 if __name__ == '__main__':
     test_check_date()
     test_str_to_sec()
     test_sec_to_str()
+    test_haversine()
+    test_summarize_track()
+    test_summarize_track_mixed_time_formats()
+    test_summarize_track_tcx()
+    test_summarize_track_bad_input()
+    test_hampel()
+    test_hampel_ends()
+    test_hampel_large_window()